@@ -0,0 +1,37 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path(".cache") / "yf"
+
+
+class FileCache:
+    """Tiny JSON-per-symbol cache so back-to-back runs skip the Yahoo round-trip."""
+
+    def __init__(self, cache_dir: Path = CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, symbol: str) -> Path:
+        return self.cache_dir / f"{symbol}.json"
+
+    def get(self, symbol: str, ttl: float = 60):
+        """Return the cached day low for `symbol`, or None if missing/stale."""
+        try:
+            entry = json.loads(self._path(symbol).read_text())
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("timestamp", 0) > ttl:
+            return None
+        return entry.get("day_low")
+
+    def set(self, symbol: str, day_low: float):
+        try:
+            self._path(symbol).write_text(
+                json.dumps({"timestamp": time.time(), "day_low": day_low})
+            )
+        except OSError as e:
+            logger.warning("Failed to cache %s: %s", symbol, e)
@@ -1,13 +1,17 @@
 import asyncio
-import yfinance as yf
+import functools
 from datetime import datetime, time, timedelta
-import pytz
+from zoneinfo import ZoneInfo
 import os
+import numpy as np
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 from dotenv import load_dotenv
 import aiohttp
 import logging
 
+from cache import FileCache
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,164 +21,321 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 MONGO_URI = os.getenv("MONGODB_URI")
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+
+IST = ZoneInfo("Asia/Kolkata")
 
-# MongoDB setup
-client = AsyncIOMotorClient(MONGO_URI)
-db = client["stock_zones"]
-trade_collection = db["trades"]
+# Day-low cache: short TTL keeps intraday data fresh while letting
+# back-to-back runs (e.g. this bot and the companion script) share fetches
+cache = FileCache()
+CACHE_TTL = 60
 
-IST = pytz.timezone("Asia/Kolkata")
+YF_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+# Yahoo rejects requests without a browser-ish User-Agent
+YF_HEADERS = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) stock-alert-bot"}
 
+@functools.lru_cache(maxsize=4096)
 def patch_symbol(symbol: str) -> str:
     """Appends '.NS' if no exchange suffix found (assumes NSE by default)."""
     if '.' not in symbol:
         return symbol + '.NS'
     return symbol
 
-async def send_telegram_message(message: str):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+# Telegram allows ~30 messages/sec per bot; stay under it so bursts of
+# entry alerts don't trigger 429 storms
+TG_MAX_CONCURRENCY = 25
+
+# Yahoo rate-limits aggressive clients; keep the fan-out polite
+YF_MAX_CONCURRENCY = 10
+
+_tg_sem = None
+_yf_sem = None
+
+def _telegram_sem() -> asyncio.Semaphore:
+    # Created lazily so the semaphore binds to the running event loop
+    global _tg_sem
+    if _tg_sem is None:
+        _tg_sem = asyncio.Semaphore(TG_MAX_CONCURRENCY)
+    return _tg_sem
+
+def _yahoo_sem() -> asyncio.Semaphore:
+    global _yf_sem
+    if _yf_sem is None:
+        _yf_sem = asyncio.Semaphore(YF_MAX_CONCURRENCY)
+    return _yf_sem
+
+async def send_telegram_message(session: aiohttp.ClientSession, message: str):
     payload = {"chat_id": TELEGRAM_CHAT_ID, "text": message, "parse_mode": "Markdown"}
-    logger.info("Sending Telegram Message: %s", payload)
-    
-    async with aiohttp.ClientSession() as session:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sending Telegram Message: %s", payload)
+
+    async with _telegram_sem():
         for attempt in range(3):
-            async with session.post(url, data=payload) as resp:
+            async with session.post(TELEGRAM_URL, data=payload) as resp:
                 if resp.status == 429:
-                    retry_after = int(resp.headers.get("Retry-After", 1))
-                    logger.warning("Rate limit hit, retrying after %s seconds", retry_after)
-                    await asyncio.sleep(retry_after)
+                    # Honor Retry-After but back off exponentially regardless
+                    retry_after = int(resp.headers.get("Retry-After", 0))
+                    delay = max(retry_after, min(2 ** attempt, 30))
+                    logger.warning("Rate limit hit, retrying after %s seconds", delay)
+                    await asyncio.sleep(delay)
                     continue
                 if resp.status != 200:
                     raise Exception(f"Telegram API Error: {await resp.text()}")
-                logger.info("Message sent successfully")
+                logger.debug("Message sent successfully")
                 return
-        raise Exception("Max retries reached for Telegram API")
+    raise Exception("Max retries reached for Telegram API")
 
-async def check_trades():
-    # Check market hours
-    now = datetime.now(IST)
-    if now.weekday() >= 5 or now.time() < time(9, 15) or now.time() > time(23, 30):
-        logger.info("Outside market hours (9:15 AM - 3:30 PM IST), exiting.")
-        exit(0)
+async def fetch_day_low(session: aiohttp.ClientSession, symbol: str):
+    """Fetches today's low for `symbol` straight from Yahoo's chart endpoint."""
+    url = YF_CHART_URL.format(symbol=symbol)
+    params = {"interval": "1d", "range": "1d"}
+    async with _yahoo_sem():
+        async with session.get(url, params=params, headers=YF_HEADERS) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    lows = data["chart"]["result"][0]["indicators"]["quote"][0]["low"]
+    lows = [v for v in lows if v is not None]
+    return float(min(lows)) if lows else None
 
+async def _send_alert(session: aiohttp.ClientSession, sem: asyncio.Semaphore,
+                      raw_symbol, message):
+    """Send one alert (if any), bounded by `sem`. Returns True on success."""
+    async with sem:
+        if message is None:
+            return True
+        try:
+            await send_telegram_message(session, message)
+            return True
+        except Exception as e:
+            logger.error("Error sending alert for %s: %s", raw_symbol, e)
+            try:
+                await send_telegram_message(session, f"⚠️ Error processing trade {raw_symbol}: {str(e)}")
+            except Exception:
+                logger.exception("Failed to report error for %s", raw_symbol)
+            return False
+
+async def check_trades(session: aiohttp.ClientSession, trade_collection):
+    now = datetime.now(IST)
     logger.info("Checking Trades...")
 
-    # Fetch all open trades
-    trades = await trade_collection.find({"status": "OPEN"}).to_list(None)
-    if not trades:
+    # Idempotent; lets the OPEN-trade match and distinct() run off an index
+    await trade_collection.create_index([("status", 1), ("symbol", 1)])
+
+    # Resolve the symbol set server-side instead of materializing every trade
+    raw_symbols = await trade_collection.distinct("symbol", {"status": "OPEN"})
+    if not raw_symbols:
         logger.info("No open trades found.")
         return
 
-    total_trades = len(trades)
-    logger.info("Found %d open trades.", total_trades)
-
-    # Get unique symbols
-    tickers = list(set(patch_symbol(trade["symbol"]) for trade in trades))
+    tickers = {patch_symbol(s) for s in raw_symbols}
     total_tickers = len(tickers)
-    logger.info("Unique symbols to fetch: %s (%d total)", tickers, total_tickers)
+    logger.info("Unique symbols to fetch: %s (%d total)", sorted(tickers), total_tickers)
 
-    # Fetch data once per symbol
+    # Fetch data once per symbol, serving recent values from the file cache
     price_data = {}
-    logger.info("Fetching stock data...")
-    try:
-        data = yf.download(tickers, period="1d", group_by="ticker")
-        for i, symbol in enumerate(tickers, 1):
-            if symbol in data and not data[symbol].empty:
-                price_data[symbol] = data[symbol]["Low"].iloc[-1]
-                logger.info("Fetched data for %s: Day Low ₹%.2f (%d/%d)", 
-                            symbol, price_data[symbol], i, total_tickers)
+    miss_tickers = []
+    for symbol in tickers:
+        day_low = cache.get(symbol, ttl=CACHE_TTL)
+        if day_low is not None:
+            price_data[symbol] = day_low
+        else:
+            miss_tickers.append(symbol)
+    if price_data:
+        logger.info("Cache hits for %d/%d symbols", len(price_data), total_tickers)
+
+    if miss_tickers:
+        logger.info("Fetching stock data...")
+        results = await asyncio.gather(
+            *(fetch_day_low(session, symbol) for symbol in miss_tickers),
+            return_exceptions=True,
+        )
+        errors = []
+        for i, (symbol, day_low) in enumerate(zip(miss_tickers, results), 1):
+            if isinstance(day_low, Exception):
+                errors.append(day_low)
+                logger.warning("Error fetching %s: %s (%d/%d)", symbol, day_low, i, len(miss_tickers))
+            elif day_low is None:
+                logger.warning("No data for %s (%d/%d)", symbol, i, len(miss_tickers))
             else:
-                logger.warning("No data for %s (%d/%d)", symbol, i, total_tickers)
-    except Exception as e:
-        logger.error("Error fetching batch data: %s", e)
-        await send_telegram_message(f"⚠️ Error fetching stock data: {str(e)}")
+                price_data[symbol] = day_low
+                cache.set(symbol, day_low)
+                logger.debug("Fetched data for %s: Day Low ₹%.2f (%d/%d)",
+                             symbol, day_low, i, len(miss_tickers))
+        if not price_data:
+            # Tell the operator once rather than per symbol: an unattended
+            # run with no prices at all means no alerts for the day
+            detail = str(errors[0]) if errors else "no data returned"
+            await send_telegram_message(
+                session,
+                f"⚠️ Error fetching stock data: 0/{len(miss_tickers)} symbols resolved ({detail})"
+            )
+
+    # Annotate each trade with its day low server-side and let Mongo return
+    # only the alert-eligible documents instead of every OPEN trade
+    price_by_raw = {raw: price_data.get(patch_symbol(raw)) for raw in raw_symbols}
+    branches = [
+        {"case": {"$eq": ["$symbol", raw]}, "then": float(low)}
+        for raw, low in price_by_raw.items()
+        if low is not None
+    ]
+    if not branches:
+        logger.info("No price data for any symbol, nothing to process.")
+        return
 
-    # Process trades using cached price data
+    after_close = now.hour > 15 or (now.hour == 15 and now.minute >= 30)
+    alert_conditions = [
+        # Approaching: within 2% of entry price and not already alerted
+        {"$and": [
+            {"$ne": ["$alert_sent", True]},
+            {"$gt": [{"$abs": {"$subtract": ["$entry_price", "$day_low"]}}, 0]},
+            {"$lte": [{"$divide": [{"$abs": {"$subtract": ["$entry_price", "$day_low"]}},
+                                   "$entry_price"]}, 0.02]},
+        ]},
+        # Entry hit
+        {"$and": [
+            {"$ne": ["$entry_alert_sent", True]},
+            {"$lte": ["$day_low", "$entry_price"]},
+        ]},
+    ]
+    if after_close:
+        # End-of-day reset of stale approaching alerts
+        alert_conditions.append({"$and": [
+            {"$eq": ["$alert_sent", True]},
+            {"$ne": ["$entry_alert_sent", True]},
+        ]})
+    # Trades alerted in the last 30 minutes are filtered out server-side
+    # (last_alert_time is always written timezone-aware by this bot)
+    alert_cutoff = now - timedelta(minutes=30)
+    pipeline = [
+        {"$match": {"status": "OPEN", "entry_price": {"$type": ["int", "long", "double"], "$gt": 0},
+                    "$or": [{"last_alert_time": {"$exists": False}},
+                            {"last_alert_time": None},
+                            {"last_alert_time": {"$lt": alert_cutoff}}]}},
+        {"$addFields": {"day_low": {"$switch": {"branches": branches, "default": None}}}},
+        {"$match": {"day_low": {"$ne": None}, "$expr": {"$or": alert_conditions}}},
+        # Only ship the fields the processing loop actually reads
+        {"$project": {"symbol": 1, "entry_price": 1, "alert_sent": 1,
+                      "entry_alert_sent": 1, "day_low": 1}},
+    ]
+
+    # Single pass over the cursor: buffer each eligible trade and its
+    # classification inputs together, so every document is touched once
+    # right after BSON decode
     logger.info("Processing trades...")
-    for i, trade in enumerate(trades, 1):
-        raw_symbol = trade.get("symbol")
-        trade_id = trade.get("_id")
-        entry_price = trade.get("entry_price")
-        alert_sent = trade.get("alert_sent", False)
-        entry_alert_sent = trade.get("entry_alert_sent", False)
-        last_alert_time = trade.get("last_alert_time")
-
-        if not all([raw_symbol, trade_id, isinstance(entry_price, (int, float))]):
-            logger.info("Skipping trade: Invalid data (symbol=%s, trade_id=%s, entry_price=%s) (%d/%d)", 
-                        raw_symbol, trade_id, entry_price, i, total_trades)
-            continue
-
-        symbol = patch_symbol(raw_symbol)
-        day_low = price_data.get(symbol)
-        if day_low is None:
-            logger.info("Skipping %s: No price data (%d/%d)", raw_symbol, i, total_trades)
-            continue
-
-        # Handle offset-naive last_alert_time
-        if last_alert_time and not last_alert_time.tzinfo:
-            last_alert_time = IST.localize(last_alert_time)
-
-        # Prevent duplicate alerts within 30 minutes
-        if last_alert_time and now - last_alert_time < timedelta(minutes=30):
-            logger.info("Skipping alert for %s: Recent alert sent (%d/%d)", raw_symbol, i, total_trades)
-            continue
-
-        logger.info("Trade Check: %s | Trade ID: %s (%d/%d)", raw_symbol, trade_id, i, total_trades)
-        logger.info("Entry Price ₹%.2f | Day Low ₹%.2f | Time: %s", 
-                    entry_price, day_low, now.strftime('%H:%M'))
+    records = []
+    entry_vals, low_vals, alert_flags, entry_flags = [], [], [], []
+    async for trade in trade_collection.aggregate(pipeline, batchSize=500):
+        records.append(trade)
+        entry_vals.append(trade["entry_price"])
+        low_vals.append(trade["day_low"])
+        alert_flags.append(bool(trade.get("alert_sent")))
+        entry_flags.append(bool(trade.get("entry_alert_sent")))
 
-        try:
-            # Approaching Alert (within 2% of entry price)
-            if not alert_sent and 0 < abs(entry_price - day_low) / entry_price <= 0.02:
-                msg = f"⚠️ *{raw_symbol}* is approaching entry price ₹{entry_price:.2f}\nDay Low: ₹{day_low:.2f}"
-                await send_telegram_message(msg)
-                await trade_collection.update_one(
-                    {"_id": trade_id}, 
-                    {"$set": {"alert_sent": True, "last_alert_time": now}}
-                )
-                logger.info("Sent approaching alert for %s (%d/%d)", raw_symbol, i, total_trades)
-
-            # Entry Hit Alert
-            elif not entry_alert_sent and day_low <= entry_price:
-                msg = f"✅ *{raw_symbol}* has hit the entry price ₹{entry_price:.2f}\nDay Low: ₹{day_low:.2f}"
-                await send_telegram_message(msg)
-                await trade_collection.update_one(
-                    {"_id": trade_id}, 
-                    {"$set": {"entry_alert_sent": True, "last_alert_time": now}}
-                )
-                logger.info("Sent entry alert for %s (%d/%d)", raw_symbol, i, total_trades)
-
-            # Reset alert after market close (3:30 PM IST)
-            elif alert_sent and not entry_alert_sent and (now.hour > 15 or (now.hour == 15 and now.minute >= 30)):
-                await trade_collection.update_one(
-                    {"_id": trade_id}, 
-                    {"$set": {"alert_sent": False, "last_alert_time": now}}
-                )
-                logger.info("Reset alert for %s at end of day (%d/%d)", raw_symbol, i, total_trades)
+    if not records:
+        logger.info("No trades need alerts.")
+        return
 
-        except Exception as e:
-            logger.error("Error processing trade %s: %s (%d/%d)", trade_id, e, i, total_trades)
-            await send_telegram_message(f"⚠️ Error processing trade {raw_symbol}: {str(e)}")
+    # Classify all trades at once with vectorized comparisons
+    entry = np.array(entry_vals, dtype=np.float64)
+    low = np.array(low_vals, dtype=np.float64)
+    alert_sent = np.array(alert_flags)
+    entry_sent = np.array(entry_flags)
 
-async def main():
-    # Validate environment variables
-    if not all([TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, MONGO_URI]):
-        error_msg = "Missing required environment variables: TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, or MONGODB_URI"
-        logger.error(error_msg)
-        await send_telegram_message(error_msg)
-        exit(1)
+    proximity = np.abs(entry - low) / entry
+    # Same precedence as the old if/elif chain: approaching, then entry hit,
+    # then the after-close reset of stale approaching alerts
+    approach_mask = ~alert_sent & (proximity > 0) & (proximity <= 0.02)
+    entry_mask = ~approach_mask & ~entry_sent & (low <= entry)
+    if after_close:
+        reset_mask = ~approach_mask & ~entry_mask & alert_sent & ~entry_sent
+    else:
+        reset_mask = np.zeros(len(records), dtype=bool)
+
+    sem = asyncio.Semaphore(10)
+    pending = []
+    for idx in np.nonzero(approach_mask | entry_mask | reset_mask)[0]:
+        trade = records[idx]
+        raw_symbol = trade["symbol"]
+        trade_id = trade["_id"]
+        entry_price = entry[idx]
+        day_low = low[idx]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Trade Check: %s | Trade ID: %s", raw_symbol, trade_id)
+            logger.debug("Entry Price ₹%.2f | Day Low ₹%.2f | Time: %s",
+                         entry_price, day_low, now.strftime('%H:%M'))
+
+        # Approaching Alert (within 2% of entry price)
+        if approach_mask[idx]:
+            msg = f"⚠️ *{raw_symbol}* is approaching entry price ₹{entry_price:.2f}\nDay Low: ₹{day_low:.2f}"
+            pending.append((
+                asyncio.create_task(_send_alert(session, sem, raw_symbol, msg)),
+                UpdateOne({"_id": trade_id}, {"$set": {"alert_sent": True, "last_alert_time": now}}),
+            ))
+            logger.debug("Queued approaching alert for %s", raw_symbol)
+
+        # Entry Hit Alert
+        elif entry_mask[idx]:
+            msg = f"✅ *{raw_symbol}* has hit the entry price ₹{entry_price:.2f}\nDay Low: ₹{day_low:.2f}"
+            pending.append((
+                asyncio.create_task(_send_alert(session, sem, raw_symbol, msg)),
+                UpdateOne({"_id": trade_id}, {"$set": {"entry_alert_sent": True, "last_alert_time": now}}),
+            ))
+            logger.debug("Queued entry alert for %s", raw_symbol)
+
+        # Reset alert after market close (3:30 PM IST)
+        else:
+            pending.append((
+                asyncio.create_task(_send_alert(session, sem, raw_symbol, None)),
+                UpdateOne({"_id": trade_id}, {"$set": {"alert_sent": False, "last_alert_time": now}}),
+            ))
+            logger.debug("Queued alert reset for %s at end of day", raw_symbol)
 
+    if pending:
+        results = await asyncio.gather(*(task for task, _ in pending))
+        # One bulk round-trip for every state change whose alert went out
+        updates = [op for (_, op), sent in zip(pending, results) if sent]
+        if updates:
+            await trade_collection.bulk_write(updates, ordered=False)
+        logger.info("Dispatched %d alerts, flushed %d updates in one bulk_write",
+                    len(pending), len(updates))
+
+async def main():
     start_time = datetime.now(IST)
-    try:
-        await check_trades()
-    except Exception as e:
-        logger.error("Error in main: %s", e)
-        await send_telegram_message(f"🔥 Error in trade alert: {str(e)}")
-    finally:
-        client.close()
-        logger.info("MongoDB client closed")
-        duration = (datetime.now(IST) - start_time).total_seconds()
-        logger.info("Execution completed in %.2f seconds", duration)
+    # Cheap local check before any client setup: most scheduled runs land
+    # outside market hours and should cost nothing
+    if start_time.weekday() >= 5 or start_time.time() < time(9, 15) or start_time.time() > time(23, 30):
+        logger.info("Outside market hours (9:15 AM - 3:30 PM IST), exiting.")
+        return
+    # One shared session: connection pool + keep-alive instead of a new TLS handshake per alert
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Validate environment variables
+        if not all([TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, MONGO_URI]):
+            error_msg = "Missing required environment variables: TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, or MONGODB_URI"
+            logger.error(error_msg)
+            await send_telegram_message(session, error_msg)
+            exit(1)
+
+        # Created here, not at import, so Motor binds to the running loop;
+        # the pool is sized for the bulk_write/aggregate traffic
+        client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=50, minPoolSize=5)
+        trade_collection = client["stock_zones"]["trades"]
+        try:
+            await check_trades(session, trade_collection)
+        except Exception as e:
+            logger.error("Error in main: %s", e)
+            await send_telegram_message(session, f"🔥 Error in trade alert: {str(e)}")
+        finally:
+            client.close()
+            logger.info("MongoDB client closed")
+            duration = (datetime.now(IST) - start_time).total_seconds()
+            logger.info("Execution completed in %.2f seconds", duration)
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass  # uvloop is optional (not available on Windows)
     asyncio.run(main())